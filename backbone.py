@@ -1,4 +1,4 @@
-from typing import Tuple, Optional, Type
+from typing import Tuple, Optional, Type, Sequence
 
 from torch import nn
 
@@ -8,9 +8,26 @@ from layers import (Sum, SplitTensor)
 
 
 class EfficientNetFeatureMapsExtractor(nn.Module):
-    def __init__(self, effnet: nn.Module, mode: Optional[str] = None):
+    def __init__(self,
+                 effnet: nn.Module,
+                 mode: Optional[str] = None,
+                 endpoints: Optional[Sequence[str]] = None):
+        """Constructor.
+
+        Args:
+            effnet (nn.Module): An EfficientNet from
+                lukemelas/EfficientNet-PyTorch.
+            mode (Optional[str], optional): Not implemented yet. Must be None.
+            endpoints (Optional[Sequence[str]], optional): Keys of the
+                endpoints returned by effnet.extract_endpoints() that should
+                be returned, e.g. ('reduction_2', 'reduction_3',
+                'reduction_4', 'reduction_5'). The rest are dropped right
+                away instead of being passed on to (and kept alive by) the
+                FPN. If None, all endpoints are returned. Defaults to None.
+        """
         super().__init__()
         self.m = effnet
+        self.endpoints = None if endpoints is None else list(endpoints)
 
         if mode is not None:
             # TODO implement
@@ -18,7 +35,9 @@ class EfficientNetFeatureMapsExtractor(nn.Module):
 
     def forward(self, x) -> tuple:
         feats = self.m.extract_endpoints(x)
-        return tuple(feats.values())
+        if self.endpoints is None:
+            return tuple(feats.values())
+        return tuple(feats[k] for k in self.endpoints)
 
 
 class ResNetFeatureMapsExtractor(nn.Module):
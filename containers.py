@@ -1,5 +1,6 @@
 from typing import Tuple, Callable, Any, Union
 
+import torch
 from torch import nn
 
 
@@ -92,3 +93,145 @@ class SequentialMultiInputMultiOutput(nn.Sequential):
             last_out = module((last_out, layer_inp))
             outs[i] = last_out
         return tuple(outs)
+
+
+class Autocast(nn.Module):
+    """Runs the wrapped module under torch.autocast with the given dtype and
+    casts the output back to float32.
+
+    Sub-modules that should be computed in full precision (normally the final
+    conv(s) producing the logits) can be wrapped in NoAutocast.
+    """
+
+    def __init__(self,
+                 module: nn.Module,
+                 dtype: torch.dtype = torch.bfloat16,
+                 cache_enabled: bool = True):
+        super().__init__()
+        self.module = module
+        self.dtype = dtype
+        # must be False if the module is to be captured in a CUDA graph
+        self.cache_enabled = cache_enabled
+
+    def forward(self, x: Any) -> Any:
+        device_type = _first_tensor(x).device.type
+        with torch.autocast(
+                device_type=device_type,
+                dtype=self.dtype,
+                cache_enabled=self.cache_enabled):
+            out = self.module(x)
+        return _to_dtype(out, torch.float32)
+
+
+class NoAutocast(nn.Module):
+    """Runs the wrapped module with autocast disabled and its inputs cast to
+    the dtype of its parameters, so that it is computed in full precision
+    even inside of Autocast. Outside of autocast, this changes nothing.
+    """
+
+    def __init__(self, module: nn.Module):
+        super().__init__()
+        self.module = module
+
+    def forward(self, x: Any) -> Any:
+        device_type = _first_tensor(x).device.type
+        param = next(self.module.parameters(), None)
+        with torch.autocast(device_type=device_type, enabled=False):
+            if param is not None:
+                x = _to_dtype(x, param.dtype)
+            return self.module(x)
+
+
+class CUDAGraphWrapper(nn.Module):
+    """Captures the wrapped module in a CUDA graph and replays the graph on
+    subsequent calls, replacing all the kernel launches (and the Python code
+    issuing them) with a single graph launch.
+
+    Takes in a tensor or a tuple of tensors. The graph is only used in eval
+    mode, with gradients disabled and for CUDA inputs; otherwise the wrapped
+    module is called as usual. The graph is captured (after a few warmup
+    iterations) on the first such call and re-captured whenever the shapes
+    or dtypes of the inputs change, so it is best used with a fixed batch
+    size.
+
+    Note that the outputs are static tensors that are overwritten by the next
+    call. Clone them if they need to outlive it.
+
+    The graph reads the parameters from the memory they occupied at capture
+    time. In-place updates, such as load_state_dict(), are therefore seen by
+    later replays, but moving or casting the module (e.g. .to(), .half())
+    allocates new parameters, so the graph is dropped and captured again on
+    the next call.
+    """
+
+    def __init__(self, module: nn.Module, num_warmup_iters: int = 3):
+        super().__init__()
+        self.module = module
+        self.num_warmup_iters = num_warmup_iters
+        self._graph = None
+        self._static_inputs = None
+        self._static_outputs = None
+
+    def forward(self, x: Union[torch.Tensor, tuple]) -> Any:
+        xs = (x, ) if isinstance(x, torch.Tensor) else tuple(x)
+        if self.training or torch.is_grad_enabled() or not xs[0].is_cuda:
+            return self.module(x)
+
+        if self._graph is None or not self._matches(xs):
+            self._capture(xs, is_tensor=isinstance(x, torch.Tensor))
+
+        for static_x, new_x in zip(self._static_inputs, xs):
+            static_x.copy_(new_x)
+        self._graph.replay()
+        return self._static_outputs
+
+    def reset(self) -> None:
+        """Drop the captured graph so that it is re-captured on the next
+        call."""
+        self._graph = None
+        self._static_inputs = None
+        self._static_outputs = None
+
+    def _apply(self, fn, *args, **kwargs):
+        # parameters may be replaced by new tensors, invalidating the graph
+        self.reset()
+        return super()._apply(fn, *args, **kwargs)
+
+    def _matches(self, xs: tuple) -> bool:
+        if len(xs) != len(self._static_inputs):
+            return False
+        return all(x.shape == static_x.shape and x.dtype == static_x.dtype
+                   and x.device == static_x.device
+                   for x, static_x in zip(xs, self._static_inputs))
+
+    def _capture(self, xs: tuple, is_tensor: bool) -> None:
+        static_inputs = tuple(x.clone() for x in xs)
+        inp = static_inputs[0] if is_tensor else static_inputs
+
+        # warm up on a side stream, as required before capture
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(self.num_warmup_iters):
+                self.module(inp)
+        torch.cuda.current_stream().wait_stream(stream)
+
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph):
+            static_outputs = self.module(inp)
+
+        self._graph = graph
+        self._static_inputs = static_inputs
+        self._static_outputs = static_outputs
+
+
+def _first_tensor(x: Any) -> torch.Tensor:
+    if isinstance(x, torch.Tensor):
+        return x
+    return _first_tensor(x[0])
+
+
+def _to_dtype(x: Any, dtype: torch.dtype) -> Any:
+    if isinstance(x, torch.Tensor):
+        return x.to(dtype)
+    return type(x)(_to_dtype(a, dtype) for a in x)
@@ -1,13 +1,15 @@
-from typing import Tuple, Optional
+from typing import Tuple, Optional, Sequence
+from copy import deepcopy
+from functools import lru_cache
 
 import torch
 from torch import nn
 import torchvision as tv
 
-from containers import Parallel
+from containers import (Parallel, Autocast, NoAutocast, CUDAGraphWrapper)
 from layers import (Interpolate, AddAcross, SplitTensor, SelectOne)
 from fpn import (FPN, PanopticFPN, PANetFPN)
-from utils import (copy_conv_weights, _get_shapes)
+from utils import (copy_conv_weights, _get_backbone_shapes)
 from backbone import (ResNetFeatureMapsExtractor, make_fusion_resnet_backbone,
                       EfficientNetFeatureMapsExtractor)
 
@@ -18,7 +20,11 @@ def make_fpn_resnet(name: str = 'resnet18',
                     fpn_channels: int = 256,
                     num_classes: int = 1000,
                     pretrained: bool = True,
-                    in_channels: int = 3) -> nn.Module:
+                    in_channels: int = 3,
+                    upsample_logits: bool = True,
+                    amp_dtype: Optional[torch.dtype] = None,
+                    use_cuda_graph: bool = False,
+                    compile_mode: Optional[str] = None) -> nn.Module:
     """Create an FPN model with a ResNet backbone.
 
     If `in_channels > 3`, uses the fusion technique described in the paper,
@@ -45,6 +51,36 @@ def make_fpn_resnet(name: str = 'resnet18',
             3, conv1 is replaced with a smaller one. If greater than 3, a
             FuseNet-style architecture is used to incorporate the new channels.
             In both cases, pretrained weights are retained. Defaults to 3.
+        upsample_logits (bool, optional): If True, the logits are upsampled
+            to out_size. If False, the model returns the logits at the
+            resolution of the largest feature map (e.g. 1/4 of the input for
+            ResNets) and it is up to the caller to downsample the labels to
+            match, e.g. with
+            F.interpolate(labels[:, None].float(), size=logits.shape[-2:],
+            mode='nearest')[:, 0].long(). This saves having to compute and
+            store a num_classes x out_size tensor on every forward pass, at
+            the cost of computing the loss at a lower resolution.
+            Defaults to True.
+        amp_dtype (Optional[torch.dtype], optional): If not None, the FPN
+            runs under torch.autocast with this dtype (e.g. torch.bfloat16),
+            which halves the memory traffic through its memory-bound
+            group_norm and upsampling layers. The backbone is not affected and
+            the final conv(s) producing the logits are run in float32 for
+            numerical stability. Defaults to None.
+        use_cuda_graph (bool, optional): If True, the FPN is captured in a
+            CUDA graph on the first inference call (eval mode, no gradients,
+            CUDA input) and the graph is replayed on later calls. This gets
+            rid of the per-layer Python and kernel launch overhead, which
+            dominates at the small feature map sizes. Requires a fixed batch
+            size. Cannot be combined with compile_mode. See
+            CUDAGraphWrapper. Defaults to False.
+        compile_mode (Optional[str], optional): If not None, the model is
+            wrapped in torch.compile (PyTorch >= 2.1) with this mode, which
+            lets Inductor fuse the conv-group_norm-relu blocks into single
+            kernels. 'reduce-overhead' is a good choice for inference and
+            'max-autotune' for training. Since 'reduce-overhead' already uses
+            CUDA graphs, this cannot be combined with use_cuda_graph.
+            Defaults to None.
 
     Raises:
         NotImplementedError: On unknown fpn_style.
@@ -59,70 +95,33 @@ def make_fpn_resnet(name: str = 'resnet18',
     resnet = tv.models.resnet.__dict__[name](pretrained=pretrained)
     if in_channels == 3:
         backbone = ResNetFeatureMapsExtractor(resnet)
+    elif not pretrained:
+        # just replace the first conv layer
+        resnet.conv1 = _adapt_first_conv(
+            resnet.conv1, in_channels, copy_weights=False)
+        backbone = ResNetFeatureMapsExtractor(resnet)
+    elif in_channels > 3:
+        # the backbone for the new channels starts off as a copy of the
+        # pretrained one rather than having to be constructed and loaded again
+        new_resnet = deepcopy(resnet)
+        new_resnet.conv1 = _adapt_first_conv(resnet.conv1, in_channels - 3)
+        backbone = make_fusion_resnet_backbone(resnet, new_resnet)
     else:
-        old_conv = resnet.conv1
-        old_conv_args = {
-            'out_channels': old_conv.out_channels,
-            'kernel_size': old_conv.kernel_size,
-            'stride': old_conv.stride,
-            'padding': old_conv.padding,
-            'dilation': old_conv.dilation,
-            'groups': old_conv.groups,
-            'bias': old_conv.bias
-        }
-        if not pretrained:
-            # just replace the first conv layer
-            new_conv = nn.Conv2d(in_channels=in_channels, **old_conv_args)
-            resnet.conv1 = new_conv
-            backbone = ResNetFeatureMapsExtractor(resnet)
-        else:
-            if in_channels > 3:
-                new_channels = in_channels - 3
-                new_conv = nn.Conv2d(in_channels=new_channels, **old_conv_args)
-
-                resnet_cls = tv.models.resnet.__dict__[name]
-                new_resnet = resnet_cls(pretrained=pretrained)
-                new_resnet.conv1 = copy_conv_weights(old_conv, new_conv)
-
-                backbone = make_fusion_resnet_backbone(resnet, new_resnet)
-            else:
-                new_conv = nn.Conv2d(in_channels=in_channels, **old_conv_args)
-                resnet.conv1 = copy_conv_weights(old_conv, new_conv)
-                backbone = ResNetFeatureMapsExtractor(resnet)
-
-    feat_shapes = _get_shapes(backbone, channels=in_channels, size=out_size)
-    if fpn_type == 'fpn':
-        fpn = nn.Sequential(
-            FPN(feat_shapes,
-                hidden_channels=fpn_channels,
-                out_channels=num_classes),
-            SelectOne(idx=0))
-    elif fpn_type == 'panoptic':
-        fpn = PanopticFPN(
-            feat_shapes,
-            hidden_channels=fpn_channels,
-            out_channels=num_classes)
-    elif fpn_type == 'panet':
-        fpn1 = FPN(
-            feat_shapes,
-            hidden_channels=fpn_channels,
-            out_channels=fpn_channels)
-
-        feat_shapes = [(n, fpn_channels, h, w) for (n, c, h, w) in feat_shapes]
-        fpn2 = FPN(
-            feat_shapes[::-1],
-            hidden_channels=fpn_channels,
-            out_channels=num_classes)
-        fpn = nn.Sequential(PANetFPN(fpn1, fpn2), SelectOne(idx=0))
-    else:
-        raise NotImplementedError()
+        resnet.conv1 = _adapt_first_conv(resnet.conv1, in_channels)
+        backbone = ResNetFeatureMapsExtractor(resnet)
 
-    # yapf: disable
-    model = nn.Sequential(
+    feat_shapes = _get_backbone_shapes(
+        backbone, name=name, channels=in_channels, size=out_size)
+    fpn = _make_fpn(fpn_type, feat_shapes, fpn_channels, num_classes)
+    model = _make_model(
         backbone,
         fpn,
-        Interpolate(size=out_size, mode='bilinear', align_corners=True))
-    # yapf: enable
+        out_size=out_size,
+        align_corners=True,
+        upsample_logits=upsample_logits,
+        amp_dtype=amp_dtype,
+        use_cuda_graph=use_cuda_graph,
+        compile_mode=compile_mode)
     return model
 
 
@@ -130,12 +129,46 @@ def _load_efficientnet(name: str,
                        num_classes: int = 1000,
                        pretrained: Optional[str] = 'imagenet',
                        in_channels: int = 3) -> nn.Module:
-    model = torch.hub.load(
-        'lukemelas/EfficientNet-PyTorch',
+    # return a copy so that callers are free to modify or train it
+    model = _load_efficientnet_cached(
         name,
         num_classes=num_classes,
         pretrained=pretrained,
         in_channels=in_channels)
+    return deepcopy(model)
+
+
+@lru_cache(maxsize=4)
+def _load_efficientnet_cached(name: str,
+                              num_classes: int = 1000,
+                              pretrained: Optional[str] = 'imagenet',
+                              in_channels: int = 3) -> nn.Module:
+    """Load the model from the efficientnet_pytorch package if it is
+    installed. Otherwise, fall back to torch.hub, which is a lot slower since
+    it has to look up the repo on GitHub and re-import it.
+    """
+    try:
+        from efficientnet_pytorch import EfficientNet
+    except ImportError:
+        model = torch.hub.load(
+            'lukemelas/EfficientNet-PyTorch',
+            name,
+            num_classes=num_classes,
+            pretrained=pretrained,
+            in_channels=in_channels)
+        return model
+
+    # e.g. efficientnet_b0 --> efficientnet-b0
+    model_name = name.replace('_', '-')
+    if pretrained is None:
+        model = EfficientNet.from_name(
+            model_name, in_channels=in_channels, num_classes=num_classes)
+    else:
+        model = EfficientNet.from_pretrained(
+            model_name,
+            advprop=(pretrained == 'advprop'),
+            in_channels=in_channels,
+            num_classes=num_classes)
     return model
 
 
@@ -145,9 +178,15 @@ def make_fpn_efficientnet(name: str = 'efficientnet_b0',
                           fpn_channels: int = 256,
                           num_classes: int = 1000,
                           pretrained: Optional[str] = 'imagenet',
-                          in_channels: str = 3) -> nn.Module:
+                          in_channels: str = 3,
+                          endpoints: Optional[Sequence[str]] = None,
+                          upsample_logits: bool = True,
+                          amp_dtype: Optional[torch.dtype] = None,
+                          use_cuda_graph: bool = False,
+                          compile_mode: Optional[str] = None) -> nn.Module:
     """Loads the PyTorch implementation of EfficientNet from
-    https://github.com/lukemelas/EfficientNet-PyTorch using torch.hub.
+    https://github.com/lukemelas/EfficientNet-PyTorch, either from the
+    efficientnet_pytorch package, if installed, or using torch.hub.
 
     Args:
         name (str, optional): Name of the EfficientNet backbone. Only those
@@ -172,6 +211,27 @@ def make_fpn_efficientnet(name: str = 'efficientnet_b0',
             currently different from make_fpn_resnet. See
             lukemelas/EfficientNet-PyTorch for the in_channels < 3 case.
             Defaults to 3.
+        endpoints (Optional[Sequence[str]], optional): Keys of the
+            EfficientNet endpoints to feed into the FPN, e.g.
+            ('reduction_2', 'reduction_3', 'reduction_4', 'reduction_5').
+            If None, all endpoints are used. Defaults to None.
+        upsample_logits (bool, optional): If False, the model returns the
+            logits at the resolution of the largest feature map (1/2 of the
+            input for EfficientNets) instead of at out_size. See
+            make_fpn_resnet for details. Defaults to True.
+        amp_dtype (Optional[torch.dtype], optional): If not None, the FPN
+            runs under torch.autocast with this dtype. See make_fpn_resnet
+            for details. Defaults to None.
+        use_cuda_graph (bool, optional): If True, the FPN is captured in a
+            CUDA graph for inference. Cannot be combined with compile_mode.
+            See make_fpn_resnet for details. Defaults to False.
+        compile_mode (Optional[str], optional): If not None, the model is
+            wrapped in torch.compile (PyTorch >= 2.1) with this mode, which
+            lets Inductor fuse the conv-group_norm-relu blocks into single
+            kernels. 'reduce-overhead' is a good choice for inference and
+            'max-autotune' for training. Since 'reduce-overhead' already uses
+            CUDA graphs, this cannot be combined with use_cuda_graph.
+            Defaults to None.
 
     Raises:
         NotImplementedError: On unknown fpn_style.
@@ -193,13 +253,52 @@ def make_fpn_efficientnet(name: str = 'efficientnet_b0',
         backbone = nn.Sequential(
             SplitTensor((3, new_channels), dim=1),
             Parallel([
-                EfficientNetFeatureMapsExtractor(effnet),
-                EfficientNetFeatureMapsExtractor(new_effnet)
+                EfficientNetFeatureMapsExtractor(effnet, endpoints=endpoints),
+                EfficientNetFeatureMapsExtractor(
+                    new_effnet, endpoints=endpoints)
             ]), AddAcross())
     else:
-        backbone = EfficientNetFeatureMapsExtractor(effnet)
+        backbone = EfficientNetFeatureMapsExtractor(
+            effnet, endpoints=endpoints)
 
-    feat_shapes = _get_shapes(backbone, channels=in_channels, size=out_size)
+    feat_shapes = _get_backbone_shapes(
+        backbone, channels=in_channels, size=out_size)
+    fpn = _make_fpn(fpn_type, feat_shapes, fpn_channels, num_classes)
+    model = _make_model(
+        backbone,
+        fpn,
+        out_size=out_size,
+        align_corners=False,
+        upsample_logits=upsample_logits,
+        amp_dtype=amp_dtype,
+        use_cuda_graph=use_cuda_graph,
+        compile_mode=compile_mode)
+    return model
+
+
+def _adapt_first_conv(old_conv: nn.Conv2d,
+                      in_channels: int,
+                      copy_weights: bool = True) -> nn.Conv2d:
+    """Make a copy of old_conv that takes in in_channels channels. If
+    copy_weights is True, the weights of old_conv are copied over (and
+    repeated if in_channels is larger than old_conv.in_channels).
+    """
+    new_conv = nn.Conv2d(
+        in_channels=in_channels,
+        out_channels=old_conv.out_channels,
+        kernel_size=old_conv.kernel_size,
+        stride=old_conv.stride,
+        padding=old_conv.padding,
+        dilation=old_conv.dilation,
+        groups=old_conv.groups,
+        bias=old_conv.bias is not None)
+    if copy_weights:
+        new_conv = copy_conv_weights(old_conv, new_conv)
+    return new_conv
+
+
+def _make_fpn(fpn_type: str, feat_shapes: Sequence[Tuple[int, ...]],
+              fpn_channels: int, num_classes: int) -> nn.Module:
     if fpn_type == 'fpn':
         fpn = nn.Sequential(
             FPN(feat_shapes,
@@ -211,24 +310,69 @@ def make_fpn_efficientnet(name: str = 'efficientnet_b0',
             feat_shapes,
             hidden_channels=fpn_channels,
             out_channels=num_classes)
-    elif fpn_type == 'panet+fpn':
-        feat_shapes2 = [(n, fpn_channels, h, w)
-                        for (n, c, h, w) in feat_shapes]
-        fpn = nn.Sequential(
-            PANetFPN(
-                feat_shapes,
-                hidden_channels=fpn_channels,
-                out_channels=fpn_channels),
-            FPN(feat_shapes2,
-                hidden_channels=fpn_channels,
-                out_channels=num_classes),
-            SelectOne(idx=0))
+    elif fpn_type == 'panet':
+        fpn1 = FPN(
+            feat_shapes,
+            hidden_channels=fpn_channels,
+            out_channels=fpn_channels)
+
+        feat_shapes = [(n, fpn_channels, h, w) for (n, c, h, w) in feat_shapes]
+        fpn2 = FPN(
+            feat_shapes[::-1],
+            hidden_channels=fpn_channels,
+            out_channels=num_classes)
+        fpn = nn.Sequential(PANetFPN(fpn1, fpn2), SelectOne(idx=0))
     else:
         raise NotImplementedError()
-    # yapf: disable
-    model = nn.Sequential(
-        backbone,
-        fpn,
-        Interpolate(size=out_size, mode='bilinear', align_corners=False))
-    # yapf: enable
+    return fpn
+
+
+def _make_model(backbone: nn.Module,
+                fpn: nn.Module,
+                out_size: Tuple[int, int],
+                align_corners: bool,
+                upsample_logits: bool = True,
+                amp_dtype: Optional[torch.dtype] = None,
+                use_cuda_graph: bool = False,
+                compile_mode: Optional[str] = None) -> nn.Module:
+    """Put together the backbone and the FPN, applying the options common to
+    all the factory functions.
+    """
+    if use_cuda_graph and compile_mode is not None:
+        raise ValueError('use_cuda_graph cannot be combined with compile_mode, '
+                         'as the compiled model would capture the graph again.')
+    if amp_dtype is not None:
+        _keep_logits_in_fp32(fpn)
+        fpn = Autocast(
+            fpn, dtype=amp_dtype, cache_enabled=not use_cuda_graph)
+    if use_cuda_graph:
+        fpn = CUDAGraphWrapper(fpn)
+
+    layers = [backbone, fpn]
+    if upsample_logits:
+        layers.append(
+            Interpolate(
+                size=out_size, mode='bilinear', align_corners=align_corners))
+    model = nn.Sequential(*layers)
+    model.to(memory_format=torch.channels_last)
+    if compile_mode is not None:
+        # all shapes are fixed by out_size, so let Inductor specialize on them
+        model = torch.compile(model, mode=compile_mode, dynamic=False)
     return model
+
+
+def _keep_logits_in_fp32(fpn: nn.Module) -> None:
+    """Wrap the modules of an FPN made by _make_fpn that produce the logits
+    in NoAutocast, in place, so that they run in float32 under Autocast.
+    """
+    if isinstance(fpn, nn.Sequential) and isinstance(fpn[-1], SelectOne):
+        fpn = fpn[0]
+    if isinstance(fpn, PANetFPN):
+        # the 2nd FPN produces the logits
+        fpn = fpn[2]
+    if isinstance(fpn, FPN):
+        out_convs = fpn[3]
+        for i, conv in enumerate(out_convs):
+            out_convs[i] = NoAutocast(conv)
+    elif isinstance(fpn, PanopticFPN):
+        fpn[3] = NoAutocast(fpn[3])
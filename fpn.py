@@ -1,9 +1,12 @@
 from typing import Tuple, Sequence, Optional, Iterable
 
+import torch
 from torch import nn
+from torch.utils.checkpoint import checkpoint
 
-from containers import (Parallel, SequentialMultiInputMultiOutput)
-from layers import (Residual, Interpolate, Reverse, Sum)
+from containers import Parallel
+from layers import (Interpolate, Reverse, Sum, UpsampleAndAdd,
+                    ChannelShuffle)
 
 
 class FPN(nn.Sequential):
@@ -50,7 +53,9 @@ class FPN(nn.Sequential):
     def __init__(self,
                  in_feats_shapes: Sequence[Tuple[int, ...]],
                  hidden_channels: int = 256,
-                 out_channels: int = 2):
+                 out_channels: int = 2,
+                 internal_upsample_mode: str = 'nearest',
+                 streaming_inference: bool = False):
         """Constructor.
 
         Args:
@@ -62,6 +67,21 @@ class FPN(nn.Sequential):
                 Defaults to 256.
             out_channels (int, optional): Number of output channels. This will
                 normally be the number of classes. Defaults to 2.
+            internal_upsample_mode (str, optional): Interpolation mode used
+                to upsample feature maps in the top-down pathway. As in the
+                original FPN, defaults to 'nearest', which is several times
+                cheaper than 'bilinear' (one source pixel read per output
+                pixel instead of four, and no blending). Defaults to
+                'nearest'.
+            streaming_inference (bool, optional): If True, when gradients are
+                disabled, the levels are processed one at a time, from the
+                deepest to the shallowest, with each lateral and merged
+                feature map being freed as soon as the next level has been
+                merged. Peak memory then holds just two hidden_channels-wide
+                feature maps (plus the outputs) instead of two full pyramids
+                of them. The outputs are identical. Not exposed by the factory
+                functions; pass it when constructing the FPN directly or set
+                the streaming_inference attribute. Defaults to False.
         """
         # reverse so that the deepest (i.e. produced by the deepest layer in
         # the backbone network) feature map is first.
@@ -73,11 +93,15 @@ class FPN(nn.Sequential):
             nn.Conv2d(in_channels, hidden_channels, kernel_size=1)
             for in_channels in in_feats_channels
         ])
-        upsample_and_add = SequentialMultiInputMultiOutput(*[
-            Residual(
-                Interpolate(size=s[2:], mode='bilinear', align_corners=False))
-            for s in in_feats_shapes
-        ])
+        # align_corners is only allowed for the interpolating modes
+        align_corners = None
+        if internal_upsample_mode in ('linear', 'bilinear', 'bicubic',
+                                      'trilinear'):
+            align_corners = False
+        upsample_and_add = UpsampleAndAdd(
+            sizes=[s[2:] for s in in_feats_shapes],
+            mode=internal_upsample_mode,
+            align_corners=align_corners)
         out_convs = Parallel([
             nn.Conv2d(hidden_channels, out_channels, kernel_size=3, padding=1)
             for s in in_feats_shapes
@@ -92,6 +116,24 @@ class FPN(nn.Sequential):
         ]
         # yapf: enable
         super().__init__(*layers)
+        self.streaming_inference = streaming_inference
+        self.to(memory_format=torch.channels_last)
+
+    def forward(self, xs: Sequence[torch.Tensor]) -> tuple:
+        if not self.streaming_inference or torch.is_grad_enabled():
+            return super().forward(xs)
+
+        _, in_convs, upsample_and_add, out_convs, _ = self
+        xs = xs[::-1]
+        outs = [None] * len(xs)
+        last_out = None
+        for i, x in enumerate(xs):
+            x = in_convs[i](x)
+            if last_out is not None:
+                x = upsample_and_add.merge(x, last_out, i)
+            last_out = x
+            outs[i] = out_convs[i](x)
+        return tuple(outs[::-1])
 
 
 class PanopticFPN(nn.Sequential):
@@ -138,7 +180,8 @@ class PanopticFPN(nn.Sequential):
                  out_size: Optional[int] = None,
                  num_upsamples_per_layer: Optional[Sequence[int]] = None,
                  upsamplng_factor: int = 2,
-                 num_groups_for_norm: int = 32):
+                 num_groups_for_norm: int = 32,
+                 num_groups_for_conv: int = 1):
         """Constructor.
 
         Args:
@@ -166,6 +209,12 @@ class PanopticFPN(nn.Sequential):
                 iteration. Defaults to 2.
             num_groups_for_norm (int, optional): Number of groups for group
                 norm layers. Defaults to 32.
+            num_groups_for_conv (int, optional): Number of groups for the 3x3
+                convs in the upsampling blocks. Values > 1 make these grouped
+                convs (e.g. 16), which cuts their FLOPs and parameters by that
+                factor; a channel shuffle is then added between successive
+                blocks so that information can still flow between groups. Grouped convs
+                can be slow to train on older cuDNN versions. Defaults to 1.
         """
         if num_upsamples_per_layer is None:
             num_upsamples_per_layer = list(range(len(in_feats_shapes)))
@@ -181,7 +230,8 @@ class PanopticFPN(nn.Sequential):
             in_channels=hidden_channels,
             size=out_size,
             num_upsamples_per_layer=num_upsamples_per_layer,
-            num_groups=num_groups_for_norm)
+            num_groups=num_groups_for_norm,
+            conv_groups=num_groups_for_conv)
         out_conv = nn.Conv2d(hidden_channels // 2, out_channels, kernel_size=1)
 
         # yapf: disable
@@ -193,20 +243,25 @@ class PanopticFPN(nn.Sequential):
         ]
         # yapf: enable
         super().__init__(*layers)
+        # NHWC lets the conv-GroupNorm-ReLU blocks use the optimized
+        # channels-last kernels (PyTorch >= 1.8)
+        self.to(memory_format=torch.channels_last)
 
     @classmethod
     def _make_upsamplers(cls,
                          in_channels: int,
                          size: int,
                          num_upsamples_per_layer: Iterable[int],
-                         num_groups: int = 32) -> Parallel:
+                         num_groups: int = 32,
+                         conv_groups: int = 1) -> Parallel:
         layers = []
         for num_upsamples in num_upsamples_per_layer:
             upsampler = cls._upsample_feat(
                 in_channels=in_channels,
                 num_upsamples=num_upsamples,
                 size=size,
-                num_groups=num_groups)
+                num_groups=num_groups,
+                conv_groups=conv_groups)
             layers.append(upsampler)
 
         upsamplers = Parallel(layers)
@@ -218,27 +273,33 @@ class PanopticFPN(nn.Sequential):
                        num_upsamples: int,
                        size: int,
                        scale_factor: float = 2.,
-                       num_groups: int = 32) -> nn.Sequential:
+                       num_groups: int = 32,
+                       conv_groups: int = 1) -> nn.Sequential:
         if num_upsamples == 0:
             return cls._make_upsampling_block(
                 in_channels=in_channels,
                 out_channels=in_channels // 2,
                 scale=1,
-                num_groups=num_groups)
+                num_groups=num_groups,
+                conv_groups=conv_groups)
         blocks = []
         for _ in range(num_upsamples - 1):
+            # each of these blocks is followed by another grouped conv
             blocks.append(
                 cls._make_upsampling_block(
                     in_channels=in_channels,
                     out_channels=in_channels,
                     scale=scale_factor,
-                    num_groups=num_groups))
+                    num_groups=num_groups,
+                    conv_groups=conv_groups,
+                    shuffle=conv_groups > 1))
         blocks.append(
             cls._make_upsampling_block(
                 in_channels=in_channels,
                 out_channels=in_channels // 2,
                 size=size,
-                num_groups=num_groups))
+                num_groups=num_groups,
+                conv_groups=conv_groups))
         return nn.Sequential(*blocks)
 
     @classmethod
@@ -247,16 +308,26 @@ class PanopticFPN(nn.Sequential):
                                out_channels: int = None,
                                scale: float = 2,
                                size: int = None,
-                               num_groups: int = 32) -> nn.Sequential:
+                               num_groups: int = 32,
+                               conv_groups: int = 1,
+                               shuffle: bool = False) -> nn.Sequential:
         if out_channels is None:
             out_channels = in_channels
 
         # conv block that preserves size
         conv_block = [
-            nn.Conv2d(in_channels, out_channels, kernel_size=3, padding=1),
+            nn.Conv2d(
+                in_channels,
+                out_channels,
+                kernel_size=3,
+                padding=1,
+                groups=conv_groups),
             nn.GroupNorm(num_channels=out_channels, num_groups=num_groups),
             nn.ReLU(inplace=True)
         ]
+        if shuffle:
+            # mix channels across groups for the next grouped conv
+            conv_block.append(ChannelShuffle(groups=conv_groups))
         if scale == 1:
             # don't upsample
             return nn.Sequential(*conv_block)
@@ -316,7 +387,25 @@ class PANetFPN(nn.Sequential):
 
     """
 
-    def __init__(self, fpn1: nn.Module, fpn2: nn.Module):
+    def __init__(self,
+                 fpn1: nn.Module,
+                 fpn2: nn.Module,
+                 checkpoint_stages: bool = False):
+        """Constructor.
+
+        Args:
+            fpn1 (nn.Module): The 1st (top-down) FPN.
+            fpn2 (nn.Module): The 2nd (bottom-up) FPN.
+            checkpoint_stages (bool, optional): If True, the intermediate
+                activations of each FPN are not kept around for the backward
+                pass and are instead recomputed during it. Only the outputs of
+                the two stages are stored, which cuts peak memory during
+                training at the cost of an extra forward pass through the
+                FPNs. Has no effect when gradients are disabled. Not exposed
+                by the factory functions; pass it when constructing the
+                PANetFPN directly or set the checkpoint_stages attribute.
+                Defaults to False.
+        """
         # yapf: disable
         layers = [
             fpn1,
@@ -326,3 +415,16 @@ class PANetFPN(nn.Sequential):
         ]
         # yapf: enable
         super().__init__(*layers)
+        self.checkpoint_stages = checkpoint_stages
+
+    def forward(self, xs: Sequence[torch.Tensor]) -> tuple:
+        if not (self.checkpoint_stages and torch.is_grad_enabled()):
+            return super().forward(xs)
+
+        for module in self:
+            if isinstance(module, Reverse):
+                xs = module(xs)
+                continue
+            xs = checkpoint(
+                lambda *inps, m=module: m(inps), *xs, use_reentrant=False)
+        return xs
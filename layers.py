@@ -1,3 +1,4 @@
+from typing import List, Optional, Sequence, Union
 from functools import partial
 
 import torch
@@ -7,6 +8,12 @@ from torch.nn import functional as F
 from containers import Parallel
 
 
+# Older versions of PyTorch have no bfloat16 kernels for upsampling, so
+# inputs have to be upcast to float32 for the upsampling and back again.
+_BF16_UPSAMPLE_SUPPORTED = tuple(
+    int(v) for v in torch.__version__.split('.')[:2]) >= (2, 0)
+
+
 class Residual(nn.Sequential):
     """Pass the input through a layer and add the result with the input."""
 
@@ -31,9 +38,146 @@ class ModulizedFunction(nn.Module):
         return self.fn(x)
 
 
-class Interpolate(ModulizedFunction):
-    def __init__(self, **kwargs):
-        super().__init__(F.interpolate, **kwargs)
+class Interpolate(nn.Module):
+    """Wrapper around F.interpolate.
+
+    size is converted to a List[int] once, at construction time, rather than
+    being passed on as whatever sequence it was given as. This makes the
+    module scriptable (and exportable to TensorRT) and saves F.interpolate
+    from having to normalize it on every call. For the same reason,
+    recompute_scale_factor and antialias are always passed explicitly, as
+    False.
+    """
+
+    def __init__(self,
+                 size: Optional[Union[int, Sequence[int]]] = None,
+                 scale_factor: Optional[float] = None,
+                 mode: str = 'nearest',
+                 align_corners: Optional[bool] = None):
+        super().__init__()
+        if isinstance(size, int):
+            size = (size, size)
+        self.size: Optional[List[int]] = (None if size is None else
+                                          [int(d) for d in size])
+        self.scale_factor = (None if scale_factor is None else
+                             float(scale_factor))
+        self.mode = mode
+        self.align_corners = align_corners
+
+    def forward(self, x):
+        if x.dtype == torch.bfloat16 and not _BF16_UPSAMPLE_SUPPORTED:
+            return self._interpolate(x.float()).to(torch.bfloat16)
+        return self._interpolate(x)
+
+    def _interpolate(self, x):
+        return F.interpolate(
+            x,
+            size=self.size,
+            scale_factor=self.scale_factor,
+            mode=self.mode,
+            align_corners=self.align_corners,
+            recompute_scale_factor=False,
+            antialias=False)
+
+    def extra_repr(self) -> str:
+        return (f'size={self.size}, scale_factor={self.scale_factor}, '
+                f'mode={self.mode}, align_corners={self.align_corners}')
+
+
+@torch.jit.script
+def fpn_topdown(feats: List[torch.Tensor],
+                sizes: List[List[int]],
+                mode: str = 'bilinear',
+                align_corners: Optional[bool] = None,
+                upcast_bf16: bool = False,
+                resize: Optional[List[bool]] = None) -> List[torch.Tensor]:
+    """Top-down pathway of an FPN, scripted so that the loop over the levels
+    runs without Python overhead.
+
+    The ith output is the ith feature map plus the (i-1)th output resized to
+    sizes[i]. The 1st output is simply the 1st feature map. If upcast_bf16 is
+    True, bfloat16 inputs are resized in float32. If resize is given and
+    resize[i] is False, the (i-1)th output is added as is, without resizing.
+    """
+    last_out = feats[0]
+    outs = [last_out]
+    for i in range(1, len(feats)):
+        if resize is not None and not resize[i]:
+            last_out = feats[i] + last_out
+            outs.append(last_out)
+            continue
+        x = last_out
+        if upcast_bf16 and x.dtype == torch.bfloat16:
+            x = x.float()
+        x = F.interpolate(
+            x,
+            size=sizes[i],
+            mode=mode,
+            align_corners=align_corners,
+            recompute_scale_factor=False,
+            antialias=False)
+        last_out = feats[i] + x.to(last_out.dtype)
+        outs.append(last_out)
+    return outs
+
+
+class UpsampleAndAdd(nn.Module):
+    """The top-down pathway of an FPN.
+
+    Takes in an n-tuple of feature maps, ordered from deepest to shallowest,
+    and returns an n-tuple whose ith element is the ith feature map plus the
+    (i-1)th output resized to the size of the ith feature map. The 1st output
+    is simply the 1st feature map.
+
+    The work is done by the scripted fpn_topdown function.
+    """
+
+    def __init__(self,
+                 sizes: Sequence[Sequence[int]],
+                 mode: str = 'bilinear',
+                 align_corners: Optional[bool] = False):
+        """Constructor.
+
+        Args:
+            sizes (Sequence[Sequence[int]]): Spatial sizes of the feature
+                maps, in the same order as the inputs.
+            mode (str, optional): Interpolation mode. Defaults to 'bilinear'.
+            align_corners (Optional[bool], optional): Passed to
+                F.interpolate. Defaults to False.
+        """
+        super().__init__()
+        self.sizes = [[int(d) for d in size] for size in sizes]
+        self.mode = mode
+        self.align_corners = align_corners
+        # levels that are the same size as the preceding one (e.g. the last
+        # two EfficientNet endpoints) can be added without resizing
+        self.resize = [True] + [
+            size != prev_size
+            for prev_size, size in zip(self.sizes[:-1], self.sizes[1:])
+        ]
+
+    def forward(self, xs: Sequence[torch.Tensor]) -> tuple:
+        outs = fpn_topdown(
+            list(xs),
+            self.sizes,
+            mode=self.mode,
+            align_corners=self.align_corners,
+            upcast_bf16=not _BF16_UPSAMPLE_SUPPORTED,
+            resize=self.resize)
+        return tuple(outs)
+
+    def merge(self, x: torch.Tensor, last_out: torch.Tensor,
+              i: int) -> torch.Tensor:
+        """Compute just the ith output, given the ith feature map and the
+        (i-1)th output.
+        """
+        outs = fpn_topdown([last_out, x],
+                           self.sizes[i - 1:i + 1],
+                           mode=self.mode,
+                           align_corners=self.align_corners,
+                           upcast_bf16=not _BF16_UPSAMPLE_SUPPORTED,
+                           resize=self.resize[i - 1:i + 1])
+        return outs[1]
 
 
 class SplitTensor(nn.Module):
@@ -53,6 +197,23 @@ class Sum(nn.Module):
         return sum(inps)
 
 
+class ChannelShuffle(nn.Module):
+    """Channel shuffle operation from "ShuffleNet" by Zhang et al.,
+    https://arxiv.org/abs/1707.01083. Interleaves the channels of the groups
+    of a preceding grouped conv so that a following grouped conv sees
+    channels from all of them.
+    """
+
+    def __init__(self, groups: int):
+        super().__init__()
+        self.groups = groups
+
+    def forward(self, x):
+        n, c, h, w = x.shape
+        x = x.view(n, self.groups, c // self.groups, h, w)
+        return x.transpose(1, 2).reshape(n, c, h, w)
+
+
 class AddAcross(nn.Module):
     def forward(self, inps):
         return [sum(items) for items in zip(*inps)]
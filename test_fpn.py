@@ -0,0 +1,24 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from fpn import FPN  # noqa: E402
+
+_FEAT_SHAPES = [(2, 8, 32, 32), (2, 16, 16, 16), (2, 32, 8, 8)]
+
+
+def test_streaming_inference_matches_regular_forward():
+    torch.manual_seed(0)
+    fpn = FPN(_FEAT_SHAPES, hidden_channels=16, out_channels=3).eval()
+    xs = tuple(torch.randn(*s) for s in _FEAT_SHAPES)
+
+    with torch.no_grad():
+        fpn.streaming_inference = False
+        expected = fpn(xs)
+        fpn.streaming_inference = True
+        outs = fpn(xs)
+
+    assert len(outs) == len(expected)
+    for out, exp in zip(outs, expected):
+        assert out.shape == exp.shape
+        assert torch.allclose(out, exp, atol=1e-5)
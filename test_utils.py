@@ -0,0 +1,114 @@
+from copy import deepcopy
+
+import pytest
+
+torch = pytest.importorskip('torch')
+tv = pytest.importorskip('torchvision')
+
+from torch import nn  # noqa: E402
+
+from backbone import (ResNetFeatureMapsExtractor,  # noqa: E402
+                      make_fusion_resnet_backbone)
+from fpn import FPN, PanopticFPN  # noqa: E402
+from utils import (_get_backbone_shapes, copy_conv_weights,  # noqa: E402
+                   quantize_fpn)
+
+_FEAT_SHAPES = [(1, 8, 32, 32), (1, 16, 16, 16), (1, 32, 8, 8)]
+
+
+def _forward_shapes(backbone, channels, size):
+    backbone.eval()
+    with torch.no_grad():
+        feats = backbone(torch.zeros(1, channels, *size))
+    return [tuple(f.shape) for f in feats]
+
+
+def _copy_conv_weights_loop(src_conv, dst_conv, dst_start_idx=0):
+    src_channels = src_conv.in_channels
+    dst_channels = dst_conv.in_channels
+    for dst_idx in range(dst_start_idx, dst_channels):
+        src_idx = dst_idx % src_channels - dst_start_idx
+        dst_conv.weight.data[:, dst_idx] = src_conv.weight.data[:, src_idx]
+    return dst_conv
+
+
+@pytest.mark.parametrize('src_channels,dst_channels,dst_start_idx',
+                         [(3, 3, 0), (3, 8, 0), (3, 5, 3), (3, 8, 2),
+                          (4, 7, 1)])
+def test_copy_conv_weights_matches_loop(src_channels, dst_channels,
+                                        dst_start_idx):
+    torch.manual_seed(0)
+    src_conv = nn.Conv2d(src_channels, 6, kernel_size=3)
+    dst_conv = nn.Conv2d(dst_channels, 6, kernel_size=3)
+    expected = _copy_conv_weights_loop(
+        src_conv, deepcopy(dst_conv), dst_start_idx=dst_start_idx)
+
+    out = copy_conv_weights(src_conv, dst_conv, dst_start_idx=dst_start_idx)
+
+    assert torch.equal(out.weight, expected.weight)
+
+
+@pytest.mark.parametrize('name', ['resnet18', 'resnet50'])
+@pytest.mark.parametrize('size', [(224, 224), (100, 130)])
+def test_registry_shapes_match_forward(name, size):
+    resnet = tv.models.resnet.__dict__[name](pretrained=False)
+    backbone = ResNetFeatureMapsExtractor(resnet)
+
+    shapes = _get_backbone_shapes(backbone, name=name, size=size)
+
+    expected = _forward_shapes(backbone, channels=3, size=size)
+    assert len(expected) == 5
+    assert [tuple(s) for s in shapes] == expected
+
+
+@pytest.mark.parametrize('size', [(224, 224), (100, 130)])
+def test_fusion_backbone_shapes_match_forward(size):
+    resnet = tv.models.resnet18(pretrained=False)
+    new_resnet = deepcopy(resnet)
+    new_resnet.conv1 = nn.Conv2d(
+        2, 64, kernel_size=7, stride=2, padding=3, bias=False)
+    backbone = make_fusion_resnet_backbone(resnet, new_resnet)
+
+    shapes = _get_backbone_shapes(
+        backbone, name='resnet18', channels=5, size=size)
+
+    expected = _forward_shapes(backbone, channels=5, size=size)
+    assert len(expected) == 4
+    assert [tuple(s) for s in shapes] == expected
+
+
+def _quantized_engine():
+    engines = torch.backends.quantized.supported_engines
+    for engine in ('x86', 'fbgemm', 'qnnpack'):
+        if engine in engines:
+            return engine
+    pytest.skip('no quantized engine available')
+
+
+@pytest.mark.parametrize('fpn_cls', [FPN, PanopticFPN])
+def test_quantize_fpn_close_to_float(fpn_cls):
+    torch.manual_seed(0)
+    kwargs = {'num_groups_for_norm': 8} if fpn_cls is PanopticFPN else {}
+    fpn = fpn_cls(
+        _FEAT_SHAPES, hidden_channels=32, out_channels=3, **kwargs).eval()
+    inputs = [
+        tuple(torch.randn(*s) for s in _FEAT_SHAPES) for _ in range(4)
+    ]
+    engine = _quantized_engine()
+
+    qfpn = quantize_fpn(fpn, inputs, backend=engine)
+
+    prev_engine = torch.backends.quantized.engine
+    torch.backends.quantized.engine = engine
+    try:
+        with torch.no_grad():
+            for inp in inputs:
+                out, qout = fpn(inp), qfpn(inp)
+                if isinstance(out, torch.Tensor):
+                    out, qout = (out, ), (qout, )
+                for o, qo in zip(out, qout):
+                    assert qo.shape == o.shape
+                    err = (qo - o).norm() / o.norm()
+                    assert err < 0.2
+    finally:
+        torch.backends.quantized.engine = prev_engine
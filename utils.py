@@ -1,7 +1,13 @@
-from typing import Tuple, List
+from typing import Tuple, List, Callable, Dict, Optional, Iterable, Any
+from itertools import chain
+from copy import deepcopy
+import math
 
 import torch
 from torch import nn
+from torch.ao import quantization as tq
+
+from backbone import ResNetFeatureMapsExtractor
 
 
 def copy_conv_weights(src_conv: nn.Conv2d,
@@ -22,14 +28,67 @@ def copy_conv_weights(src_conv: nn.Conv2d,
     src_channels = src_conv.in_channels
     dst_channels = dst_conv.in_channels
 
-    for dst_idx in range(dst_start_idx, dst_channels):
-        src_idx = dst_idx % src_channels - dst_start_idx
-        weights = src_conv.weight.data[:, src_idx]
-        dst_conv.weight.data[:, dst_idx] = weights
+    # gather all the source channels in one go instead of copying them over
+    # one at a time
+    dst_idxs = torch.arange(dst_start_idx, dst_channels)
+    src_idxs = dst_idxs % src_channels - dst_start_idx
+    weights = src_conv.weight.data[:, src_idxs.to(src_conv.weight.device)]
+    dst_conv.weight.data[:, dst_start_idx:] = weights
 
     return dst_conv
 
 
+def _resnet_shapes(channels: Tuple[int, ...]
+                   ) -> Callable[[Tuple[int, int]], List[Tuple[int, ...]]]:
+    """Shapes of the feature maps returned by ResNetFeatureMapsExtractor:
+    the stem (stride 4) followed by layer1 (stride 4) through layer4
+    (stride 32). Every stride-2 op in a ResNet maps H to ceil(H / 2).
+    """
+
+    def fn(size: Tuple[int, int]) -> List[Tuple[int, ...]]:
+        h, w = size
+        strides = (4, 4, 8, 16, 32)
+        return [(1, c, math.ceil(h / s), math.ceil(w / s))
+                for c, s in zip(channels, strides)]
+
+    return fn
+
+
+_BASIC_RESNET_CHANNELS = (64, 64, 128, 256, 512)
+_BOTTLENECK_RESNET_CHANNELS = (64, 256, 512, 1024, 2048)
+
+# Known feature map shapes for standard backbones, as a function of the input
+# size. Saves having to run a forward pass to find them out.
+_BACKBONE_SHAPES: Dict[str, Callable] = {
+    'resnet18': _resnet_shapes(_BASIC_RESNET_CHANNELS),
+    'resnet34': _resnet_shapes(_BASIC_RESNET_CHANNELS),
+    'resnet50': _resnet_shapes(_BOTTLENECK_RESNET_CHANNELS),
+    'resnet101': _resnet_shapes(_BOTTLENECK_RESNET_CHANNELS),
+    'resnet152': _resnet_shapes(_BOTTLENECK_RESNET_CHANNELS),
+    'resnext50_32x4d': _resnet_shapes(_BOTTLENECK_RESNET_CHANNELS),
+    'resnext101_32x8d': _resnet_shapes(_BOTTLENECK_RESNET_CHANNELS),
+    'wide_resnet50_2': _resnet_shapes(_BOTTLENECK_RESNET_CHANNELS),
+    'wide_resnet101_2': _resnet_shapes(_BOTTLENECK_RESNET_CHANNELS),
+}
+
+
+def _get_backbone_shapes(model: nn.Module,
+                         name: Optional[str] = None,
+                         channels: int = 3,
+                         size: Tuple[int, int] = (224, 224)
+                         ) -> List[Tuple[int, ...]]:
+    """Look up the shapes of the feature maps computed by the backbone in
+    _BACKBONE_SHAPES. The registry describes plain (non-fusion)
+    ResNetFeatureMapsExtractor's only, so for any other model, or if name is
+    not in there, fall back to _get_shapes.
+    """
+    is_plain_resnet = (isinstance(model, ResNetFeatureMapsExtractor)
+                       and model.mode != 'fusion')
+    if is_plain_resnet and name in _BACKBONE_SHAPES:
+        return _BACKBONE_SHAPES[name](size)
+    return _get_shapes(model, channels=channels, size=size)
+
+
 def _get_shapes(model: nn.Module,
                 channels: int = 3,
                 size: Tuple[int, int] = (224, 224)) -> List[Tuple[int, ...]]:
@@ -37,14 +96,35 @@ def _get_shapes(model: nn.Module,
 
     The model must be an nn.Module whose __call__ method returns all feature
     maps when called with an input.
+
+    The forward pass is run on the meta device, so only shapes are propagated
+    and no actual computation is done. If some op in the model has no meta
+    implementation (or otherwise fails on it), or if torch.func is not
+    available (PyTorch < 2.0), a regular forward pass on the CPU is done
+    instead.
     """
     # save state so we can restore laterD
     state = model.training
 
     model.eval()
     with torch.no_grad():
-        x = torch.empty(1, channels, *size)
-        feats = model(x)
+        feats = None
+        # torch.func only exists in PyTorch >= 2.0
+        if hasattr(torch, 'func'):
+            try:
+                x = torch.empty(1, channels, *size, device='meta')
+                params_and_buffers = {
+                    name: t.to('meta')
+                    for name, t in chain(model.named_parameters(),
+                                         model.named_buffers())
+                }
+                feats = torch.func.functional_call(model, params_and_buffers,
+                                                   (x, ))
+            except (NotImplementedError, RuntimeError):
+                feats = None
+        if feats is None:
+            x = torch.empty(1, channels, *size)
+            feats = model(x)
 
     # restore state
     model.train(state)
@@ -54,3 +134,70 @@ def _get_shapes(model: nn.Module,
 
     feat_shapes = [f.shape for f in feats]
     return feat_shapes
+
+
+def quantize_fpn(fpn: nn.Module,
+                 calibration_inputs: Iterable[Any],
+                 backend: str = 'x86') -> nn.Module:
+    """Post-training static int8 quantization of an FPN (or of any of the
+    other heads in fpn.py) for CPU inference, using eager mode
+    torch.ao.quantization.
+
+    Every conv, and every upsampler of a PanopticFPN as a whole, becomes a
+    quantized island: its input is quantized on the way in and its output
+    dequantized on the way out. Within an upsampler, the interpolations and
+    channel shuffles between the conv-group_norm-relu blocks therefore run on
+    quantized tensors. Weights are quantized per-channel. Everything in
+    between the islands (the resizing and adding in the top-down pathway of
+    an FPN, Sum etc.) stays in float.
+
+    Args:
+        fpn (nn.Module): The FPN. It is not modified.
+        calibration_inputs (Iterable[Any]): Inputs to the FPN (i.e. tuples of
+            backbone feature maps) that are used to calibrate the ranges of
+            the activations.
+        backend (str, optional): Quantization backend. 'x86' (or 'fbgemm'
+            for PyTorch < 2.0) for x86 CPUs or 'qnnpack' for ARM.
+            Defaults to 'x86'.
+
+    Returns:
+        nn.Module: A quantized copy of fpn. torch.backends.quantized.engine is
+        restored to its previous value before returning; if that differs
+        from backend, set it to backend before running the quantized model.
+    """
+    qconfig = tq.get_default_qconfig(backend)
+
+    # the engine is process-global state, so only change it for the duration
+    # of the calibration and conversion
+    prev_engine = torch.backends.quantized.engine
+    torch.backends.quantized.engine = backend
+    try:
+        model = deepcopy(fpn).eval()
+        _insert_quant_stubs(model, qconfig)
+        tq.prepare(model, inplace=True)
+        with torch.no_grad():
+            for inp in calibration_inputs:
+                model(inp)
+        tq.convert(model, inplace=True)
+    finally:
+        torch.backends.quantized.engine = prev_engine
+    return model
+
+
+def _insert_quant_stubs(module: nn.Module, qconfig: Any) -> None:
+    for name, child in module.named_children():
+        if isinstance(child, nn.Conv2d) or _is_conv_chain(child):
+            island = nn.Sequential(tq.QuantStub(), child, tq.DeQuantStub())
+            island.qconfig = qconfig
+            setattr(module, name, island)
+        else:
+            _insert_quant_stubs(child, qconfig)
+
+
+def _is_conv_chain(module: nn.Module) -> bool:
+    """True for a plain nn.Sequential that starts with a conv, possibly
+    nested, such as a PanopticFPN upsampling block or a whole upsampler made
+    up of such blocks."""
+    while type(module) is nn.Sequential and len(module) > 0:
+        module = module[0]
+    return isinstance(module, nn.Conv2d)